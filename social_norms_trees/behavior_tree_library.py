@@ -7,22 +7,50 @@ class Behavior:
     name: str
     id: Optional[str] = None
 
+    # Bookkeeping for the structural hash (see tree_hashing.py). Neither field
+    # takes part in equality or the repr.
+    parent: Optional["Composite"] = field(default=None, repr=False, compare=False)
+    _hash: Optional[str] = field(default=None, repr=False, compare=False)
+
+    def invalidate_hash(self):
+        """Clear the cached hash of this node and every ancestor."""
+        node = self
+        while node is not None and node._hash is not None:
+            node._hash = None
+            node = node.parent
+
 
 @dataclass
 class Composite:
     name: str
     children: List[Behavior] = field(default_factory=list)
 
+    parent: Optional["Composite"] = field(default=None, repr=False, compare=False)
+    _hash: Optional[str] = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        for child in self.children:
+            child.parent = self
+
+    invalidate_hash = Behavior.invalidate_hash
+
     def add_child(self, child: Behavior):
         self.children.append(child)
+        child.parent = self
+        self.invalidate_hash()
 
     def insert_child(self, index: int, child: Behavior):
         if 0 <= index <= len(self.children):
             self.children.insert(index, child)
+            child.parent = self
+            self.invalidate_hash()
 
     def remove_child(self, child: Behavior):
         if child in self.children:
             self.children.remove(child)
+            if child.parent is self:
+                child.parent = None
+            self.invalidate_hash()
 
 
 @dataclass
@@ -0,0 +1,183 @@
+from array import array
+from datetime import datetime, timedelta
+import logging
+import time
+from typing import Dict, Iterator, List, Optional
+
+_logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Action log
+# =============================================================================
+
+# The action history of a milestone used to be built as a list of small dicts
+# while the participant worked. The log below keeps one typed array per field
+# instead, with node names interned, so that a long session costs a few bytes
+# per action. When the milestone is saved, `to_json` gives exactly the dicts
+# saved as db["action_history"], and the columns, which also have the node ids
+# and positions, are saved under db["action_log"].
+
+MOVE, REMOVE, ADD = 0, 1, 2
+
+ACTION_TYPES = {MOVE: "move_node", REMOVE: "remove_node", ADD: "add_node"}
+
+# Used for positions that don't apply to an action (e.g. the target of a remove)
+NO_POSITION = -1
+
+
+class ActionLog:
+    """Struct-of-arrays log of the actions performed during a milestone.
+
+    Timestamps are taken with `time.perf_counter_ns`, so they are monotonic;
+    they are converted to wall-clock time relative to when the log was created.
+
+    Examples:
+        >>> log = ActionLog()
+        >>> log.record(MOVE, "unlock_cabinet", "unlock the cabinet", source=1, target=0)
+        >>> log.record(ADD, "request_medicine", "request medicine", target=2)
+        >>> len(log)
+        2
+        >>> [(e["type"], e["source"], e["target"]) for e in log]
+        [('move_node', 1, 0), ('add_node', -1, 2)]
+
+        The JSON form matches the shape used in the results file:
+        >>> for entry in log.to_json():
+        ...     print({k: v for k, v in entry.items() if k != "timestamp"})
+        {'type': 'move_node', 'nodes': [{'display_name': 'unlock the cabinet'}]}
+        {'type': 'add_node', 'node': {'name': 'request medicine'}}
+    """
+
+    def __init__(self):
+        self.types = array("b")
+        self.nodes = array("l")
+        self.sources = array("l")
+        self.targets = array("l")
+        self.timestamps = array("q")
+
+        # Interned nodes: position in these lists is the code stored in `nodes`
+        self.node_ids: List[Optional[str]] = []
+        self.node_names: List[str] = []
+        self._node_codes: Dict[tuple, int] = {}
+
+        # Anchor used to turn perf_counter_ns readings into datetimes
+        self.start_date = datetime.now()
+        self.start_ns = time.perf_counter_ns()
+
+    def __len__(self):
+        return len(self.types)
+
+    def _intern(self, node_id: Optional[str], name: str) -> int:
+        key = (node_id, name)
+        code = self._node_codes.get(key)
+        if code is None:
+            code = self._node_codes[key] = len(self.node_names)
+            self.node_ids.append(node_id)
+            self.node_names.append(name)
+        return code
+
+    def record(
+        self,
+        action_type: int,
+        node_id: Optional[str],
+        name: str,
+        source: int = NO_POSITION,
+        target: int = NO_POSITION,
+    ):
+        self.types.append(action_type)
+        self.nodes.append(self._intern(node_id, name))
+        self.sources.append(source)
+        self.targets.append(target)
+        self.timestamps.append(time.perf_counter_ns())
+
+    def timestamp(self, i: int) -> datetime:
+        elapsed = self.timestamps[i] - self.start_ns
+        return self.start_date + timedelta(microseconds=elapsed // 1000)
+
+    def __iter__(self) -> Iterator[dict]:
+        for i in range(len(self)):
+            node = self.nodes[i]
+            yield {
+                "type": ACTION_TYPES[self.types[i]],
+                "id": self.node_ids[node],
+                "name": self.node_names[node],
+                "source": self.sources[i],
+                "target": self.targets[i],
+                "timestamp": self.timestamp(i),
+            }
+
+    def to_json(self) -> List[dict]:
+        """Export the log as the list of dicts saved as db["action_history"]."""
+        result = []
+        for i in range(len(self)):
+            name = self.node_names[self.nodes[i]]
+            action_type = self.types[i]
+            if action_type == ADD:
+                entry = {"type": ACTION_TYPES[action_type], "node": {"name": name}}
+            else:
+                entry = {
+                    "type": ACTION_TYPES[action_type],
+                    "nodes": [{"display_name": name}],
+                }
+            entry["timestamp"] = self.timestamp(i).isoformat()
+            result.append(entry)
+        return result
+
+    def to_columns(self) -> dict:
+        """Export the log column by column, losing nothing.
+
+        Examples:
+            >>> log = ActionLog()
+            >>> log.record(REMOVE, "a", "do a", source=0)
+            >>> columns = log.to_columns()
+            >>> columns["types"], columns["sources"], columns["node_names"]
+            ([1], [0], ['do a'])
+            >>> ActionLog.from_columns(columns).to_json() == log.to_json()
+            True
+        """
+        return {
+            "start_date": self.start_date.isoformat(),
+            "start_ns": self.start_ns,
+            "node_ids": list(self.node_ids),
+            "node_names": list(self.node_names),
+            "types": self.types.tolist(),
+            "nodes": self.nodes.tolist(),
+            "sources": self.sources.tolist(),
+            "targets": self.targets.tolist(),
+            "timestamps": self.timestamps.tolist(),
+        }
+
+    @classmethod
+    def from_columns(cls, columns: dict) -> "ActionLog":
+        log = cls()
+        log.start_date = datetime.fromisoformat(columns["start_date"])
+        log.start_ns = columns["start_ns"]
+        for node_id, name in zip(columns["node_ids"], columns["node_names"]):
+            log._intern(node_id, name)
+        log.types.extend(columns["types"])
+        log.nodes.extend(columns["nodes"])
+        log.sources.extend(columns["sources"])
+        log.targets.extend(columns["targets"])
+        log.timestamps.extend(columns["timestamps"])
+        return log
+
+
+def milestone_actions(milestone: dict) -> List[dict]:
+    """The actions of a saved milestone, in the `action_history` dict shape.
+
+    Works for milestones saved with `action_history` as well as for those that
+    only have an `action_log`.
+
+    Examples:
+        >>> log = ActionLog()
+        >>> log.record(REMOVE, "a", "do a", source=0)
+        >>> actions = milestone_actions({"action_log": log.to_columns()})
+        >>> actions == log.to_json()
+        True
+        >>> milestone_actions({"action_history": actions}) == actions
+        True
+    """
+    if "action_history" in milestone:
+        return milestone["action_history"]
+    if "action_log" in milestone:
+        return ActionLog.from_columns(milestone["action_log"]).to_json()
+    return []
@@ -0,0 +1,285 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import logging
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# from social_norms_trees.behavior_tree_library import Behavior, Composite
+# from social_norms_trees.atomic_mutations import remove, insert, move
+from behavior_tree_library import Behavior, Composite
+from atomic_mutations import remove, insert, move
+
+_logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Counterfactual reachability
+# =============================================================================
+
+# A subgoal tree is a single composite whose children are behaviors, so its
+# canonical form is the tuple of its child ids -- the same thing
+# `serialize_tree` writes to the results db. The search runs over these
+# tuples; `apply_edits` replays a path onto real nodes with the atomic
+# mutations.
+
+TreeState = Tuple[str, ...]
+
+
+class Edit(NamedTuple):
+    """One atomic mutation, as the participant would perform it in the UI.
+
+    `index` is the position passed to `move`/`insert`; it is None for `remove`.
+    """
+
+    op: str
+    node_id: str
+    index: Optional[int] = None
+
+
+def neighbors(
+    state: TreeState, bank: Tuple[str, ...], allow_duplicates: bool = True
+) -> List[Tuple[Edit, TreeState]]:
+    """All trees one `move`, `remove` or `insert` away from `state`.
+
+    Examples:
+        >>> for edit, new in neighbors(("a", "b"), bank=("c",)):
+        ...     print(edit.op, edit.node_id, edit.index, new)
+        move a 1 ('b', 'a')
+        move b 0 ('b', 'a')
+        remove a None ('b',)
+        remove b None ('a',)
+        insert c 0 ('c', 'a', 'b')
+        insert c 1 ('a', 'c', 'b')
+        insert c 2 ('a', 'b', 'c')
+    """
+    result = []
+
+    for i, node_id in enumerate(state):
+        rest = state[:i] + state[i + 1 :]
+        for j in range(len(state)):
+            if j != i:
+                result.append(
+                    (Edit("move", node_id, j), rest[:j] + (node_id,) + rest[j:])
+                )
+
+    for i, node_id in enumerate(state):
+        result.append((Edit("remove", node_id), state[:i] + state[i + 1 :]))
+
+    for node_id in bank:
+        if not allow_duplicates and node_id in state:
+            continue
+        for j in range(len(state) + 1):
+            result.append(
+                (Edit("insert", node_id, j), state[:j] + (node_id,) + state[j:])
+            )
+
+    return result
+
+
+def _expand(frontier, bank, allow_duplicates, limit=None):
+    # Module level so that it can be shipped to worker processes. Duplicates
+    # within the chunk are dropped here to keep the results sent back small,
+    # and no more than `limit` trees are sent back, since the search can't
+    # keep more than that; the flag says whether any were left out.
+    expanded = {}
+    for state in frontier:
+        for edit, new in neighbors(state, bank, allow_duplicates):
+            if new not in expanded:
+                if limit is not None and len(expanded) >= limit:
+                    return list(expanded.values()), True
+                expanded[new] = (state, edit, new)
+    return list(expanded.values()), False
+
+
+def _chunks(items: List, n: int) -> Iterable[List]:
+    size = max(1, -(-len(items) // n))
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+@dataclass
+class ReachabilityReport:
+    """Summary of a reachability search."""
+
+    base: TreeState
+    max_edits: int
+    sizes_by_depth: List[int]
+    truncated: bool
+    paths: Dict[TreeState, Optional[List[Edit]]] = field(default_factory=dict)
+
+    @property
+    def reachable(self) -> int:
+        return sum(self.sizes_by_depth)
+
+
+class ReachabilityExplorer:
+    """Breadth-first search over edits from a base tree.
+
+    Trees are deduplicated on their canonical form, so every reachable tree is
+    visited once, at its minimum edit distance from the base.
+
+    As in the UI, a bank behavior can be inserted again while it is already in
+    the tree; pass `allow_duplicates=False` to leave those trees out.
+
+    Examples:
+        >>> explorer = ReachabilityExplorer(("a", "b"), bank=("c",), max_edits=1)
+        >>> report = explorer.run(observed=[("b", "a"), ("c",), ("a", "b")])
+        >>> report.sizes_by_depth
+        [1, 6]
+        >>> report.paths[("b", "a")]
+        [Edit(op='move', node_id='a', index=1)]
+        >>> report.paths[("a", "b")]
+        []
+        >>> print(report.paths[("c",)])
+        None
+
+        >>> report = ReachabilityExplorer(("c",), bank=("c",), max_edits=1).run(
+        ...     observed=[("c", "c")])
+        >>> report.paths[("c", "c")]
+        [Edit(op='insert', node_id='c', index=0)]
+        >>> report = ReachabilityExplorer(("c",), ("c",), 1, allow_duplicates=False)
+        >>> print(report.run(observed=[("c", "c")]).paths[("c", "c")])
+        None
+
+        Trees that would exceed the memory bound are not explored:
+        >>> report = ReachabilityExplorer(("a", "b"), ("c",), 3, max_states=5).run()
+        >>> report.truncated, report.reachable
+        (True, 5)
+    """
+
+    def __init__(
+        self,
+        base: Iterable[str],
+        bank: Iterable[str],
+        max_edits: int,
+        prune: Optional[Callable[[TreeState], bool]] = None,
+        max_states: Optional[int] = None,
+        allow_duplicates: bool = True,
+        processes: Optional[int] = None,
+    ):
+        self.base = tuple(base)
+        self.bank = tuple(bank)
+        self.max_edits = max_edits
+        self.prune = prune
+        self.max_states = max_states
+        self.allow_duplicates = allow_duplicates
+        self.processes = processes
+
+        # state -> (previous state, edit that produced it)
+        self._parents: Dict[TreeState, Optional[Tuple[TreeState, Edit]]] = {}
+        # Set when a worker left trees of the current level out
+        self._level_cut = False
+
+    def _expand_level(self, frontier, pool):
+        # A generator, so that the next level is checked against `max_states`
+        # as it is produced instead of being built in full first
+        if pool is None or len(frontier) < 2:
+            for state in frontier:
+                for edit, new in neighbors(state, self.bank, self.allow_duplicates):
+                    yield state, edit, new
+            return
+
+        limit = None
+        if self.max_states is not None:
+            limit = self.max_states - len(self._parents)
+        futures = [
+            pool.submit(_expand, chunk, self.bank, self.allow_duplicates, limit)
+            for chunk in _chunks(frontier, self.processes)
+        ]
+        for future in futures:
+            expanded, cut = future.result()
+            self._level_cut = self._level_cut or cut
+            yield from expanded
+
+    def run(self, observed: Iterable[Iterable[str]] = ()) -> ReachabilityReport:
+        self._parents = {self.base: None}
+        sizes_by_depth = [1]
+        truncated = False
+        frontier = [self.base]
+
+        pool = None
+        if self.processes is not None and self.processes > 1:
+            pool = ProcessPoolExecutor(max_workers=self.processes)
+
+        try:
+            for depth in range(1, self.max_edits + 1):
+                next_frontier = []
+                self._level_cut = False
+                for state, edit, new in self._expand_level(frontier, pool):
+                    if new in self._parents:
+                        continue
+                    if self.prune is not None and self.prune(new):
+                        continue
+                    if (
+                        self.max_states is not None
+                        and len(self._parents) >= self.max_states
+                    ):
+                        truncated = True
+                        break
+                    self._parents[new] = (state, edit)
+                    next_frontier.append(new)
+
+                # Trees left out of this level could otherwise be reached at a
+                # later one, by a longer path than the shortest
+                truncated = truncated or self._level_cut
+
+                _logger.debug("depth %d: %d new trees", depth, len(next_frontier))
+                sizes_by_depth.append(len(next_frontier))
+                frontier = next_frontier
+                if truncated or not frontier:
+                    break
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        report = ReachabilityReport(
+            base=self.base,
+            max_edits=self.max_edits,
+            sizes_by_depth=sizes_by_depth,
+            truncated=truncated,
+        )
+        for tree in observed:
+            tree = tuple(tree)
+            report.paths[tree] = self.path_to(tree)
+        return report
+
+    def path_to(self, state: TreeState) -> Optional[List[Edit]]:
+        """Shortest list of edits from the base to `state`, if it was reached."""
+        if state not in self._parents:
+            return None
+
+        path = []
+        while self._parents[state] is not None:
+            state, edit = self._parents[state]
+            path.append(edit)
+        path.reverse()
+        return path
+
+
+def explore_subgoal(subgoal_resources, max_edits: int, observed=(), **kwargs):
+    """Run the search for one subgoal, as loaded by `load_resources`."""
+    base = [node.id for node in subgoal_resources["sub_tree"].children]
+    bank = [node.id for node in subgoal_resources["behaviors"]]
+    explorer = ReachabilityExplorer(base, bank, max_edits, **kwargs)
+    return explorer.run(observed)
+
+
+def apply_edits(tree: Composite, edits: Iterable[Edit], library: Dict[str, Behavior]):
+    """Replay edits on a tree with the atomic mutations.
+
+    Examples:
+        >>> from behavior_tree_library import Sequence
+        >>> library = {i: Behavior(name=i.upper(), id=i) for i in "abc"}
+        >>> tree = Sequence("goal", children=[library["a"], library["b"]])
+        >>> apply_edits(tree, [Edit("move", "a", 1), Edit("insert", "c", 0)], library)
+        >>> [node.id for node in tree.children]
+        ['c', 'b', 'a']
+    """
+    for edit in edits:
+        node = next((n for n in tree.children if n.id == edit.node_id), None)
+        if edit.op == "move":
+            move(node, (tree, edit.index))
+        elif edit.op == "remove":
+            remove(node, tree)
+        elif edit.op == "insert":
+            insert(library[edit.node_id], (tree, edit.index))
+        else:
+            raise ValueError(f"Unknown edit: {edit.op}")
@@ -0,0 +1,199 @@
+from dataclasses import dataclass
+import logging
+from typing import Dict, List, Optional, Set
+
+_logger = logging.getLogger(__name__)
+
+# Warnings already logged
+_reported: Set[str] = set()
+
+# =============================================================================
+# Resource file validation
+# =============================================================================
+
+# Resource files are generated as well as hand written, so they are checked
+# before anything is built from them. The check is a single pass over each
+# subgoal which, as it goes, also collects the lookups the runtime needs
+# (behaviors by id and the behavior bank), so validating costs little more
+# than the JSON parse itself.
+#
+# All problems are collected and reported together, each with its location
+# in the file, e.g. `pick_up_medicine.behavior_library[3].id`. Problems with
+# interruptions are only logged as warnings, since nothing is built from them
+# yet. Each warning is logged once per run: with `--watch` a subgoal is
+# compiled again whenever it is edited, and the log goes to the terminal the
+# participant is using.
+
+
+class ResourceValidationError(ValueError):
+    """A resource file doesn't follow the format described in examples/README.md."""
+
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+        super().__init__(
+            f"{len(errors)} problem(s) in resource file:\n  " + "\n  ".join(errors)
+        )
+
+
+@dataclass
+class CompiledSubgoal:
+    """A validated subgoal, with the indices used to build it."""
+
+    name: str
+    context: Optional[str]
+    children: List[str]
+    # behavior id -> behavior name, in library order
+    behaviors: Dict[str, str]
+    bank: List[str]
+
+
+def _check_subgoal(name, subgoal, errors: List[str]) -> Optional[CompiledSubgoal]:
+    if not isinstance(subgoal, dict):
+        errors.append(f"{name}: expected an object, got {type(subgoal).__name__}")
+        return None
+
+    context = subgoal.get("context")
+    if context is not None and not isinstance(context, str):
+        errors.append(f"{name}.context: expected a string")
+
+    behaviors = {}
+    bank = []
+    library = subgoal.get("behavior_library")
+    if not isinstance(library, list):
+        errors.append(f"{name}.behavior_library: expected a list")
+        library = []
+
+    for i, behavior in enumerate(library):
+        if not isinstance(behavior, dict):
+            errors.append(f"{name}.behavior_library[{i}]: expected an object")
+            continue
+        behavior_id = behavior.get("id")
+        behavior_name = behavior.get("name")
+        if not isinstance(behavior_id, str):
+            errors.append(f"{name}.behavior_library[{i}].id: expected a string")
+            continue
+        if not isinstance(behavior_name, str):
+            errors.append(f"{name}.behavior_library[{i}].name: expected a string")
+        if behavior_id in behaviors:
+            errors.append(
+                f"{name}.behavior_library[{i}].id: duplicate id {behavior_id!r}"
+            )
+            continue
+        behaviors[behavior_id] = behavior_name
+
+        in_bank = behavior.get("in_behavior_bank", False)
+        if in_bank is True:
+            bank.append(behavior_id)
+        elif in_bank is not False:
+            errors.append(
+                f"{name}.behavior_library[{i}].in_behavior_bank: expected true or false"
+            )
+
+    children = subgoal.get("children")
+    if not isinstance(children, list):
+        errors.append(f"{name}.children: expected a list")
+        children = []
+
+    for i, child in enumerate(children):
+        if not isinstance(child, str):
+            errors.append(f"{name}.children[{i}]: expected a string")
+            continue
+        if child not in behaviors:
+            errors.append(
+                f"{name}.children[{i}]: {child!r} is not in {name}.behavior_library"
+            )
+
+    warnings = []
+    interruptions = subgoal.get("interruptions", {})
+    if not isinstance(interruptions, dict):
+        warnings.append(f"{name}.interruptions: expected an object")
+        interruptions = {}
+
+    for key, text in interruptions.items():
+        if key not in behaviors:
+            warnings.append(
+                f"{name}.interruptions.{key}: {key!r} is not in {name}.behavior_library"
+            )
+        if not isinstance(text, str):
+            warnings.append(f"{name}.interruptions.{key}: expected a string")
+
+    for warning in warnings:
+        if warning not in _reported:
+            _reported.add(warning)
+            _logger.warning("In resource file: %s", warning)
+
+    return CompiledSubgoal(
+        name=name,
+        context=context,
+        children=children,
+        behaviors=behaviors,
+        bank=bank,
+    )
+
+
+def compile_subgoal(name: str, subgoal) -> CompiledSubgoal:
+    """Validate one subgoal, raising `ResourceValidationError` on any problem.
+
+    Examples:
+        >>> subgoal = {
+        ...     "context": "...",
+        ...     "children": ["a", "b", "a"],
+        ...     "behavior_library": [
+        ...         {"id": "a", "name": "do a"},
+        ...         {"id": "b", "name": "do b", "in_behavior_bank": False},
+        ...         {"id": "c", "name": "do c", "in_behavior_bank": True},
+        ...     ],
+        ...     "interruptions": {"b": "..."},
+        ... }
+        >>> compiled = compile_subgoal("goal", subgoal)
+        >>> compiled.behaviors, compiled.bank
+        ({'a': 'do a', 'b': 'do b', 'c': 'do c'}, ['c'])
+
+        Interruptions for unknown behaviors are only warned about:
+        >>> subgoal["interruptions"]["e"] = "..."
+        >>> compile_subgoal("goal", subgoal).children
+        ['a', 'b', 'a']
+
+        >>> subgoal["children"].append("d")
+        >>> subgoal["behavior_library"].append({"id": "c", "name": "again"})
+        >>> try:
+        ...     compile_subgoal("goal", subgoal)
+        ... except ResourceValidationError as e:
+        ...     print(e)
+        2 problem(s) in resource file:
+          goal.behavior_library[3].id: duplicate id 'c'
+          goal.children[3]: 'd' is not in goal.behavior_library
+    """
+    errors = []
+    compiled = _check_subgoal(name, subgoal, errors)
+    if errors:
+        raise ResourceValidationError(errors)
+    return compiled
+
+
+def compile_resources(resources) -> Dict[str, CompiledSubgoal]:
+    """Validate a whole resource file, reporting the problems of every subgoal.
+
+    Examples:
+        >>> try:
+        ...     compile_resources({"a": {"children": ["x"], "behavior_library": []},
+        ...                        "b": {"children": [], "behavior_library": 3}})
+        ... except ResourceValidationError as e:
+        ...     print(e)
+        2 problem(s) in resource file:
+          a.children[0]: 'x' is not in a.behavior_library
+          b.behavior_library: expected a list
+    """
+    if not isinstance(resources, dict):
+        raise ResourceValidationError(
+            [f"expected an object of subgoals, got {type(resources).__name__}"]
+        )
+
+    errors = []
+    compiled = {}
+    for name, subgoal in resources.items():
+        compiled[name] = _check_subgoal(name, subgoal, errors)
+
+    if errors:
+        raise ResourceValidationError(errors)
+    return compiled
@@ -0,0 +1,159 @@
+import json
+import logging
+import pathlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+_logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Resource file watcher
+# =============================================================================
+
+# Study designers edit resource files while a station is running. The watcher
+# polls the file's mtime and, when it changes, rebuilds only the subgoals whose
+# JSON changed. The rebuilt subgoals are swapped into the loaded resources in
+# one step by `reload`, which the experiment calls between milestones, so a
+# milestone never sees a half-updated subgoal.
+#
+# A subgoal that fails to build keeps its previous version and the error is
+# logged; a file that can't be parsed at all, or isn't an object of subgoals,
+# is ignored until it changes again.
+#
+# The watcher starts from the parsed JSON the resources were loaded from, and
+# reads the file again on the first `reload`, so an edit made after that JSON
+# was read is never missed.
+
+
+class ResourceWatcher:
+    """Reloads the subgoals of a resource file that have changed on disk.
+
+    `build` turns the JSON of one subgoal into its loaded form, e.g.
+    `ui_wrapper.build_subgoal`, and `subgoals` is the JSON the loaded
+    resources were built from.
+
+    Examples:
+        >>> import os, tempfile
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> path = pathlib.Path(directory.name) / "robot-resource-file.json"
+        >>> def write(resources, mtime):
+        ...     path.write_text(json.dumps(resources))
+        ...     os.utime(path, ns=(mtime, mtime))
+        >>> def build(name, subgoal):
+        ...     return [subgoal["library"][child] for child in subgoal["children"]]
+
+        >>> resources = {"a": {"children": ["x"], "library": {"x": "X"}},
+        ...              "b": {"children": ["y"], "library": {"y": "Y"}}}
+        >>> write(resources, 1)
+        >>> loaded = {name: build(name, sub) for name, sub in resources.items()}
+        >>> watcher = ResourceWatcher(path, build, json.loads(path.read_text()))
+
+        Nothing to do until the file changes:
+        >>> watcher.reload(loaded)
+        []
+        >>> watcher.reload(loaded)
+        []
+
+        Only the edited subgoal is rebuilt:
+        >>> resources["b"]["children"] = ["y", "y"]
+        >>> write(resources, 2)
+        >>> watcher.reload(loaded)
+        ['b']
+        >>> loaded
+        {'a': ['X'], 'b': ['Y', 'Y']}
+
+        A broken subgoal is reported and keeps its previous version:
+        >>> resources["a"]["children"] = ["missing"]
+        >>> resources["c"] = {"children": [], "library": {}}
+        >>> write(resources, 3)
+        >>> watcher.reload(loaded)
+        ['c']
+        >>> loaded
+        {'a': ['X'], 'b': ['Y', 'Y'], 'c': []}
+        >>> watcher.errors
+        {'a': "KeyError: 'missing'"}
+
+        A file that isn't an object of subgoals is ignored:
+        >>> write([1, 2], 4)
+        >>> watcher.reload(loaded)
+        []
+        >>> directory.cleanup()
+    """
+
+    def __init__(self, path, build: Callable[[str, dict], object], subgoals: dict):
+        self.path = pathlib.Path(path)
+        self.build = build
+        self.errors: Dict[str, str] = {}
+
+        # Unknown until the file is read here, so the first reload reads it
+        self._signature = None
+        self._subgoals = dict(subgoals)
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self) -> Optional[dict]:
+        try:
+            with open(self.path, "r") as f:
+                subgoals = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            _logger.warning(
+                "Could not read %s, keeping loaded resources: %s", self.path, e
+            )
+            return None
+
+        if not isinstance(subgoals, dict):
+            _logger.warning(
+                "Expected an object of subgoals in %s, got %s; keeping loaded resources",
+                self.path,
+                type(subgoals).__name__,
+            )
+            return None
+        return subgoals
+
+    def changed(self) -> bool:
+        """Whether the file has been modified since it was last read."""
+        return self._stat() != self._signature
+
+    def reload(self, all_resources: dict) -> List[str]:
+        """Rebuild changed subgoals into `all_resources`; return their names."""
+        if not self.changed():
+            return []
+
+        # Taken before reading, so a write during the read is seen next time
+        self._signature = self._stat()
+        subgoals = self._read()
+        if subgoals is None:
+            return []
+
+        updated = {}
+        reloaded = []
+        self.errors = {}
+        for name, subgoal in subgoals.items():
+            if name in all_resources and self._subgoals.get(name) == subgoal:
+                updated[name] = all_resources[name]
+                continue
+            try:
+                updated[name] = self.build(name, subgoal)
+            except Exception as e:
+                self.errors[name] = f"{type(e).__name__}: {e}"
+                _logger.warning("Not reloading subgoal %r: %s", name, self.errors[name])
+                if name in all_resources:
+                    updated[name] = all_resources[name]
+                # Remember the last good version, so the broken one is retried
+                subgoals[name] = self._subgoals.get(name)
+                continue
+            reloaded.append(name)
+
+        self._subgoals = subgoals
+        all_resources.clear()
+        all_resources.update(updated)
+
+        if reloaded:
+            _logger.info(
+                "Reloaded subgoals from %s: %s", self.path, ", ".join(reloaded)
+            )
+        return reloaded
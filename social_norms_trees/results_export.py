@@ -0,0 +1,486 @@
+import csv
+import json
+import logging
+import os
+import pathlib
+from typing import Annotated, Dict, Iterable, Iterator, List, Tuple
+
+import typer
+
+# from social_norms_trees.results_index import ResultsIndex, StoreLayoutError, robot_name
+# from social_norms_trees.event_log import ActionLog, milestone_actions, NO_POSITION
+from results_index import ResultsIndex, StoreLayoutError, robot_name
+from event_log import ActionLog, milestone_actions, NO_POSITION
+
+_logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Tables
+# =============================================================================
+
+# Each table is a list of (column, type) pairs. The types are only used for
+# the parquet schema; CSV output is untyped.
+
+TABLES = {
+    "experiments": [
+        ("experiment_id", "str"),
+        ("participant_name", "str"),
+        ("robot", "str"),
+        ("resource_file", "str"),
+        ("experiment_start_date", "str"),
+    ],
+    "milestones": [
+        ("experiment_id", "str"),
+        ("subgoal", "str"),
+        ("start_time", "str"),
+        ("end_time", "str"),
+        ("base_subtree_hash", "str"),
+        ("final_subtree_hash", "str"),
+        ("action_count", "int"),
+        ("error_log", "str"),
+    ],
+    "actions": [
+        ("experiment_id", "str"),
+        ("subgoal", "str"),
+        ("sequence", "int"),
+        ("type", "str"),
+        ("node_id", "str"),
+        ("node_name", "str"),
+        ("source", "int"),
+        ("target", "int"),
+        ("timestamp", "str"),
+    ],
+    "tree_snapshots": [
+        ("experiment_id", "str"),
+        ("subgoal", "str"),
+        ("snapshot", "str"),
+        ("position", "int"),
+        ("behavior_id", "str"),
+    ],
+}
+
+Row = Tuple
+
+
+def _action_rows(experiment_id, subgoal, milestone) -> Iterator[Row]:
+    columns = milestone.get("action_log")
+    if columns is not None:
+        for i, action in enumerate(ActionLog.from_columns(columns)):
+            # Moves have both positions, removals only a source, additions
+            # only a target
+            source, target = action["source"], action["target"]
+            yield (
+                experiment_id,
+                subgoal,
+                i,
+                action["type"],
+                action["id"],
+                action["name"],
+                None if source == NO_POSITION else source,
+                None if target == NO_POSITION else target,
+                action["timestamp"].isoformat(),
+            )
+        return
+
+    # Milestones saved before the action log only have the action history
+    for i, action in enumerate(milestone_actions(milestone)):
+        if "node" in action:
+            name = action["node"]["name"]
+        else:
+            name = action["nodes"][0]["display_name"]
+
+        yield (
+            experiment_id,
+            subgoal,
+            i,
+            action["type"],
+            None,
+            name,
+            None,
+            None,
+            action["timestamp"],
+        )
+
+
+def flatten_record(experiment_id: str, record: dict) -> Iterator[Tuple[str, Row]]:
+    """Yield (table, row) pairs for one experiment record.
+
+    Examples:
+        >>> record = {
+        ...     "participant_name": "ann",
+        ...     "experiment_start_date": "2024-01-01T10:00:00",
+        ...     "resource_file": "atlas-resource-file.json",
+        ...     "experiment_progression": {
+        ...         "pick_up_medicine": {
+        ...             "start_time": "2024-01-01T10:00:01",
+        ...             "base_subtree": ["a", "b"],
+        ...             "action_history": [
+        ...                 {"type": "remove_node", "nodes": [{"display_name": "do a"}],
+        ...                  "timestamp": "2024-01-01T10:00:02"}],
+        ...             "final_subtree": ["b"],
+        ...             "end_time": "2024-01-01T10:00:03",
+        ...         }
+        ...     },
+        ... }
+        >>> for table, row in flatten_record("e1", record):
+        ...     print(table, row)
+        experiments ('e1', 'ann', 'atlas', 'atlas-resource-file.json', '2024-01-01T10:00:00')
+        milestones ('e1', 'pick_up_medicine', '2024-01-01T10:00:01', '2024-01-01T10:00:03', None, None, 1, None)
+        actions ('e1', 'pick_up_medicine', 0, 'remove_node', None, 'do a', None, None, '2024-01-01T10:00:02')
+        tree_snapshots ('e1', 'pick_up_medicine', 'base', 0, 'a')
+        tree_snapshots ('e1', 'pick_up_medicine', 'base', 1, 'b')
+        tree_snapshots ('e1', 'pick_up_medicine', 'final', 0, 'b')
+    """
+    yield "experiments", (
+        experiment_id,
+        record.get("participant_name"),
+        robot_name(record.get("resource_file")),
+        record.get("resource_file"),
+        record.get("experiment_start_date"),
+    )
+
+    for subgoal, milestone in record.get("experiment_progression", {}).items():
+        actions = list(_action_rows(experiment_id, subgoal, milestone))
+        yield "milestones", (
+            experiment_id,
+            subgoal,
+            milestone.get("start_time"),
+            milestone.get("end_time"),
+            milestone.get("base_subtree_hash"),
+            milestone.get("final_subtree_hash"),
+            len(actions),
+            milestone.get("error_log"),
+        )
+
+        for row in actions:
+            yield "actions", row
+
+        for snapshot in ("base", "final"):
+            for position, behavior_id in enumerate(
+                milestone.get(f"{snapshot}_subtree", [])
+            ):
+                yield "tree_snapshots", (
+                    experiment_id,
+                    subgoal,
+                    snapshot,
+                    position,
+                    behavior_id,
+                )
+
+
+# =============================================================================
+# Writers
+# =============================================================================
+
+
+class CsvTableWriter:
+    """Appends rows to `<table>.csv`, writing the header for a new file."""
+
+    suffix = ".csv"
+
+    def __init__(self, directory: pathlib.Path, table: str, part: int):
+        path = directory / f"{table}{self.suffix}"
+        new_file = not path.exists() or path.stat().st_size == 0
+        self.file = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow([column for column, _ in TABLES[table]])
+
+    def write(self, rows: List[Row]):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetTableWriter:
+    """Writes rows to `<table>/part-<n>.parquet`, one row group per chunk.
+
+    Parquet files can't be appended to, so each export adds a new part; the
+    table directory can be read as a single dataset.
+    """
+
+    suffix = ".parquet"
+
+    def __init__(self, directory: pathlib.Path, table: str, part: int):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError(
+                "Parquet export requires pyarrow: pip install social-norms-trees[parquet]"
+            )
+        self.pyarrow = pyarrow
+
+        types = {"str": pyarrow.string(), "int": pyarrow.int64()}
+        self.schema = pyarrow.schema(
+            [(column, types[kind]) for column, kind in TABLES[table]]
+        )
+        (directory / table).mkdir(exist_ok=True)
+        self.writer = pyarrow.parquet.ParquetWriter(
+            directory / table / f"part-{part:05d}{self.suffix}", self.schema
+        )
+
+    def write(self, rows: List[Row]):
+        columns = list(zip(*rows))
+        batch = self.pyarrow.RecordBatch.from_arrays(
+            [
+                self.pyarrow.array(column, type=field.type)
+                for column, field in zip(columns, self.schema)
+            ],
+            schema=self.schema,
+        )
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"csv": CsvTableWriter, "parquet": ParquetTableWriter}
+
+
+# =============================================================================
+# Export pipeline
+# =============================================================================
+
+# Records are read one at a time through the results index and flattened
+# lazily, and each table buffers at most `chunk_size` rows before they are
+# written out, so memory use doesn't depend on the size of the results store.
+#
+# The state file is only written once an export has finished, and records the
+# size of every CSV file at that point. An export that fails part way leaves
+# rows behind without updating the state, so the next `--since-last` export
+# first cuts the tables back to the recorded sizes and then retries the same
+# experiments, rather than writing their rows twice.
+
+STATE_FILE = ".export-state.json"
+
+
+def _load_state(directory: pathlib.Path) -> dict:
+    path = directory / STATE_FILE
+    if not path.exists():
+        return {"db_file": None, "last_offset": -1, "exports": 0, "sizes": {}}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _save_state(directory: pathlib.Path, state: dict):
+    temporary = directory / (STATE_FILE + ".tmp")
+    with open(temporary, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(temporary, directory / STATE_FILE)
+
+
+def _csv_sizes(directory: pathlib.Path) -> Dict[str, int]:
+    sizes = {}
+    for table in TABLES:
+        path = directory / f"{table}{CsvTableWriter.suffix}"
+        if path.is_file():
+            sizes[table] = path.stat().st_size
+    return sizes
+
+
+def _rollback(directory: pathlib.Path, state: dict):
+    # Remove whatever an interrupted export wrote after the saved state
+    sizes = state.get("sizes")
+    for table in TABLES:
+        path = directory / f"{table}{CsvTableWriter.suffix}"
+        if sizes is not None and path.is_file():
+            with open(path, "r+b") as f:
+                f.truncate(sizes.get(table, 0))
+        for part in (directory / table).glob(f"part-*{ParquetTableWriter.suffix}"):
+            if int(part.stem.removeprefix("part-")) >= state["exports"]:
+                part.unlink()
+
+
+def _clear(directory: pathlib.Path):
+    # Remove the output of earlier exports, but nothing else in the directory
+    for table in TABLES:
+        for writer in WRITERS.values():
+            path = directory / f"{table}{writer.suffix}"
+            if path.is_file():
+                path.unlink()
+            elif path.with_suffix("").is_dir():
+                for part in path.with_suffix("").glob(f"part-*{writer.suffix}"):
+                    part.unlink()
+    (directory / STATE_FILE).unlink(missing_ok=True)
+
+
+def export_rows(
+    rows: Iterable[Tuple[str, Row]],
+    directory: pathlib.Path,
+    output_format: str = "csv",
+    part: int = 0,
+    chunk_size: int = 10_000,
+) -> Dict[str, int]:
+    """Write (table, row) pairs to one output per table; return the row counts."""
+    writer_type = WRITERS[output_format]
+    writers = {}
+    buffers = {table: [] for table in TABLES}
+    counts = {table: 0 for table in TABLES}
+
+    def flush(table):
+        if table not in writers:
+            writers[table] = writer_type(directory, table, part)
+        writers[table].write(buffers[table])
+        counts[table] += len(buffers[table])
+        buffers[table] = []
+
+    try:
+        for table, row in rows:
+            buffers[table].append(row)
+            if len(buffers[table]) >= chunk_size:
+                flush(table)
+        for table in TABLES:
+            if buffers[table]:
+                flush(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return counts
+
+
+def export_results(
+    db_file,
+    directory,
+    output_format: str = "csv",
+    since_last: bool = False,
+    chunk_size: int = 10_000,
+) -> Dict[str, int]:
+    """Export the results store as flat tables.
+
+    With `since_last`, only the experiments added since the previous export to
+    the same directory are written, and they are added to the existing tables.
+
+    Examples:
+        >>> import tempfile
+        >>> from results_index import append_experiments
+        >>> temporary = tempfile.TemporaryDirectory()
+        >>> tmp = pathlib.Path(temporary.name)
+        >>> def experiment(name):
+        ...     return {"participant_name": name, "experiment_progression": {
+        ...         "goal": {"base_subtree": ["a"], "final_subtree": ["a"]}}}
+
+        >>> append_experiments(tmp / "results.json", {"e1": experiment("ann")})
+        >>> export_results(tmp / "results.json", tmp / "out")["tree_snapshots"]
+        2
+        >>> append_experiments(tmp / "results.json", {"e2": experiment("bob")})
+        >>> export_results(tmp / "results.json", tmp / "out", since_last=True)
+        {'experiments': 1, 'milestones': 1, 'actions': 0, 'tree_snapshots': 2}
+        >>> print((tmp / "out" / "experiments.csv").read_text().replace("\\r", ""))
+        experiment_id,participant_name,robot,resource_file,experiment_start_date
+        e1,ann,,,
+        e2,bob,,,
+        <BLANKLINE>
+
+        Rows left by an export that failed part way are dropped before the
+        next one, which exports the same experiments again:
+        >>> append_experiments(tmp / "results.json", {"e3": experiment("cy")})
+        >>> with open(tmp / "out" / "experiments.csv", "a") as f:
+        ...     _ = f.write("e3,cy,,,\\n")
+        >>> export_results(tmp / "results.json", tmp / "out", since_last=True)
+        {'experiments': 1, 'milestones': 1, 'actions': 0, 'tree_snapshots': 2}
+        >>> (tmp / "out" / "experiments.csv").read_text().count("e3")
+        1
+
+        >>> try:
+        ...     export_results(tmp / "other.json", tmp / "out", since_last=True)
+        ... except ValueError as e:
+        ...     print(str(e).replace(str(tmp), "<tmp>"))
+        <tmp>/out holds an export of <tmp>/results.json, not <tmp>/other.json
+        >>> temporary.cleanup()
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    db_file = pathlib.Path(db_file).resolve()
+
+    if since_last:
+        state = _load_state(directory)
+        if state.get("db_file") not in (None, str(db_file)):
+            raise ValueError(
+                f"{directory} holds an export of {state['db_file']}, not {db_file}"
+            )
+        _rollback(directory, state)
+    else:
+        _clear(directory)
+        state = _load_state(directory)
+
+    last_offset = state["last_offset"]
+
+    with ResultsIndex(db_file) as index:
+
+        def entries():
+            nonlocal last_offset
+            for entry in index.iter_entries(state["last_offset"]):
+                last_offset = entry.offset
+                yield entry
+
+        rows = (
+            table_row
+            for experiment_id, record in index.iter_records(entries())
+            for table_row in flatten_record(experiment_id, record)
+        )
+        counts = export_rows(
+            rows, directory, output_format, state["exports"], chunk_size
+        )
+
+    _save_state(
+        directory,
+        {
+            "db_file": str(db_file),
+            "last_offset": last_offset,
+            "exports": state["exports"] + 1,
+            "sizes": _csv_sizes(directory),
+        },
+    )
+    return counts
+
+
+# =============================================================================
+# Command line
+# =============================================================================
+
+app = typer.Typer()
+
+
+@app.command()
+def export(
+    output_dir: Annotated[
+        pathlib.Path, typer.Argument(help="directory the tables are written to")
+    ],
+    db_file: Annotated[
+        pathlib.Path,
+        typer.Option(help="file where the experimental results are stored"),
+    ] = "experiment_results.json",
+    output_format: Annotated[
+        str, typer.Option("--format", help="csv or parquet")
+    ] = "csv",
+    since_last: Annotated[
+        bool,
+        typer.Option(
+            "--since-last", help="only export experiments added since the last export"
+        ),
+    ] = False,
+    chunk_size: Annotated[int, typer.Option(help="rows buffered per table")] = 10_000,
+):
+    """Export the experiment results as flat tables."""
+    if output_format not in WRITERS:
+        raise typer.BadParameter(f"Unknown format: {output_format}")
+    if not db_file.exists():
+        raise typer.BadParameter(f"Results file not found: {db_file}")
+
+    try:
+        counts = export_results(
+            db_file, output_dir, output_format, since_last, chunk_size
+        )
+    except StoreLayoutError as e:
+        raise typer.BadParameter(f"{db_file}: {e}; run `reindex` first")
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+    for table, count in counts.items():
+        print(f"{table}: {count} rows")
+
+
+if __name__ == "__main__":
+    app()
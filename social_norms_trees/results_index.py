@@ -0,0 +1,512 @@
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+from typing import Annotated, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import typer
+
+_logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Results store layout
+# =============================================================================
+
+# The results store is a JSON object in the layout `json.dumps(db, indent=4)`
+# produces: every top-level entry starts on a line indented by exactly four
+# spaces. Every entry is an experiment, keyed by its id.
+#
+# New entries are only ever appended after the last one, so nothing already
+# written is rewritten. A sidecar sqlite index records the byte range of every
+# entry, which lets a single experiment be read by seeking to it.
+#
+# If the index doesn't match the file, it is rebuilt by scanning the file one
+# entry at a time; the results file itself is only rewritten by an explicit
+# `reindex`, e.g. for a file that was not written in this layout.
+
+INDEX_SUFFIX = ".idx"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    experiment_id TEXT PRIMARY KEY,
+    participant TEXT,
+    robot TEXT,
+    start_date TEXT,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS experiments_participant ON experiments (participant);
+CREATE INDEX IF NOT EXISTS experiments_robot ON experiments (robot);
+CREATE INDEX IF NOT EXISTS experiments_start_date ON experiments (start_date);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value);
+"""
+
+
+class IndexEntry(NamedTuple):
+    experiment_id: str
+    participant: Optional[str]
+    robot: Optional[str]
+    start_date: Optional[str]
+    offset: int
+    length: int
+
+
+class StoreLayoutError(ValueError):
+    """The results file isn't in the layout the index needs; see `reindex`."""
+
+
+def index_path(db_file) -> pathlib.Path:
+    db_file = pathlib.Path(db_file)
+    return db_file.with_name(db_file.name + INDEX_SUFFIX)
+
+
+def robot_name(resource_file: Optional[str]) -> Optional[str]:
+    """
+    Examples:
+        >>> robot_name("atlas-resource-file.json")
+        'atlas'
+    """
+    if resource_file is None:
+        return None
+    return resource_file.removesuffix("-resource-file.json")
+
+
+def _entry_bytes(key, value) -> bytes:
+    # The text json.dumps(db, indent=4) would produce for this one entry
+    return json.dumps({key: value}, indent=4)[2:-2].encode()
+
+
+def _parse_entry(data: bytes):
+    return json.loads(b"{" + data + b"}").popitem()
+
+
+def _split_entries(f) -> Iterator[Tuple[int, bytes]]:
+    """Yield (offset, bytes) of each top-level entry, reading line by line."""
+    first = f.readline()
+    if first.strip() == b"{}" or not first:
+        return
+    if first != b"{\n":
+        raise StoreLayoutError("unexpected line at byte 0")
+
+    position = len(first)
+    start, lines = None, []
+    for line in f:
+        if line.startswith(b'    "') or line.rstrip() == b"}":
+            if start is not None:
+                data = b"".join(lines)
+                yield start, data.removesuffix(b"\n").removesuffix(b",")
+            start, lines = position, []
+            if line.rstrip() == b"}":
+                return
+        elif start is None:
+            raise StoreLayoutError(f"unexpected line at byte {position}")
+        lines.append(line)
+        position += len(line)
+
+    # The file ended inside an entry, e.g. after an interrupted write
+    if start is not None:
+        yield start, b"".join(lines)
+
+
+class ResultsIndex:
+    """Sidecar index of a results store.
+
+    Examples:
+        >>> import os, tempfile
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> db_file = pathlib.Path(directory.name) / "results.json"
+        >>> def experiment(name, date):
+        ...     return {"participant_name": name, "experiment_start_date": date,
+        ...             "experiment_progression": {},
+        ...             "resource_file": "atlas-resource-file.json"}
+
+        >>> append_experiments(db_file, {"e1": experiment("ann", "2024-01-01")})
+        >>> append_experiments(db_file, {"e2": experiment("bob", "2024-02-01")})
+
+        The file is plain JSON:
+        >>> list(json.loads(db_file.read_text()))
+        ['e1', 'e2']
+
+        >>> with ResultsIndex(db_file) as index:
+        ...     print(index.fetch("e2")["participant_name"])
+        ...     print([e.experiment_id for e in index.filter(robot="atlas")])
+        ...     print([e.experiment_id for e in index.filter(since="2024-01-15")])
+        bob
+        ['e1', 'e2']
+        ['e2']
+
+        Touching the file only costs a check of its last entry:
+        >>> os.utime(db_file)
+        >>> with ResultsIndex(db_file) as index:
+        ...     index.is_current()
+        True
+
+        A lost index is rebuilt by scanning the file, which is left as it is:
+        >>> index_path(db_file).unlink()
+        >>> before = db_file.read_bytes()
+        >>> with ResultsIndex(db_file) as index:
+        ...     print(index.fetch("e1")["participant_name"])
+        ann
+        >>> db_file.read_bytes() == before
+        True
+
+        An interrupted write leaves earlier entries readable and is
+        overwritten by the next append:
+        >>> with open(db_file, "ab") as f:
+        ...     _ = f.seek(-2, os.SEEK_END)
+        ...     _ = f.truncate()
+        ...     _ = f.write(b',\\n    "e3": {"partic')
+        >>> append_experiments(db_file, {"e4": experiment("cy", "2024-03-01")})
+        >>> list(json.loads(db_file.read_text()))
+        ['e1', 'e2', 'e4']
+        >>> directory.cleanup()
+    """
+
+    def __init__(self, db_file):
+        self.db_file = pathlib.Path(db_file)
+        self.connection = sqlite3.connect(index_path(self.db_file))
+        self.connection.executescript(_SCHEMA)
+        if not self.is_current():
+            try:
+                self.rebuild()
+            except StoreLayoutError:
+                self.close()
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    # -- bookkeeping ----------------------------------------------------------
+
+    def _meta(self, name):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, name, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value)
+        )
+
+    def _file_signature(self):
+        if not self.db_file.exists():
+            return None
+        stat = self.db_file.stat()
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _tail_matches(self) -> bool:
+        # Cheap check for a file whose mtime changed but size didn't (e.g. it
+        # was touched or copied): the last indexed entry and the closing brace
+        # must still be where the index says.
+        end = self._meta("end")
+        if end is None:
+            return self.db_file.read_bytes() in (b"", b"{}")
+        last = self._meta("last_key")
+        data = self._read(self._meta("last_offset"), end - self._meta("last_offset"))
+        try:
+            key, _ = _parse_entry(data)
+        except ValueError:
+            return False
+        return key == last and self._read(end, 3) == b"\n}"
+
+    def is_current(self) -> bool:
+        """Whether the index describes the results file as it is on disk."""
+        signature = self._meta("signature")
+        current = self._file_signature()
+        if signature == current:
+            return True
+        if signature is None or current is None:
+            return False
+        if signature.split(":")[0] == current.split(":")[0] and self._tail_matches():
+            self._commit()
+            return True
+        return False
+
+    def _commit(self):
+        self._set_meta("signature", self._file_signature())
+        self.connection.commit()
+
+    def _add(self, key, value, offset, length):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                value.get("participant_name"),
+                robot_name(value.get("resource_file")),
+                value.get("experiment_start_date"),
+                offset,
+                length,
+            ),
+        )
+        self._set_meta("last_key", key)
+        self._set_meta("last_offset", offset)
+        self._set_meta("end", offset + length)
+
+    def rebuild(self):
+        """Rebuild the index by scanning the results file, which is not changed.
+
+        Entries are read one at a time, so this doesn't hold the store in
+        memory. An incomplete entry at the end of the file (from an
+        interrupted write) is left out of the index.
+        """
+        _logger.info("Rebuilding index of %s", self.db_file)
+        self.connection.execute("DELETE FROM experiments")
+        self.connection.execute("DELETE FROM meta")
+
+        if self.db_file.exists():
+            with open(self.db_file, "rb") as f:
+                for offset, data in _split_entries(f):
+                    try:
+                        key, value = _parse_entry(data)
+                    except ValueError:
+                        _logger.warning(
+                            "Ignoring incomplete entry at byte %d of %s",
+                            offset,
+                            self.db_file,
+                        )
+                        break
+                    self._add(key, value, offset, len(data))
+        self._commit()
+
+    # -- writing --------------------------------------------------------------
+
+    def _read(self, offset, length) -> bytes:
+        with open(self.db_file, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def append(self, db: dict):
+        """Add the experiments of `db` after the last entry."""
+        entries = list(db.items())
+        if not entries:
+            return
+
+        end = self._meta("end")
+        with open(self.db_file, "r+b" if self.db_file.exists() else "wb") as f:
+            # Anything after the last indexed entry is the closing brace or
+            # the remains of an interrupted write
+            if end is None:
+                f.seek(0)
+                f.write(b"{\n")
+            else:
+                f.seek(end)
+                f.write(b",\n")
+            for i, (key, value) in enumerate(entries):
+                if i:
+                    f.write(b",\n")
+                data = _entry_bytes(key, value)
+                self._add(key, value, f.tell(), len(data))
+                f.write(data)
+            f.write(b"\n}")
+            f.truncate()
+
+        self._commit()
+
+    # -- queries --------------------------------------------------------------
+
+    def lookup(self, experiment_id: str) -> Optional[IndexEntry]:
+        row = self.connection.execute(
+            "SELECT * FROM experiments WHERE experiment_id = ?", (experiment_id,)
+        ).fetchone()
+        return None if row is None else IndexEntry(*row)
+
+    def filter(
+        self,
+        participant: Optional[str] = None,
+        robot: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> List[IndexEntry]:
+        """Experiments matching all the given fields, in file order.
+
+        `since` and `until` are compared against the ISO start date, so a
+        prefix such as "2024-05" works.
+        """
+        clauses, params = [], []
+        for clause, value in (
+            ("participant = ?", participant),
+            ("robot = ?", robot),
+            ("start_date >= ?", since),
+            ("start_date < ?", until),
+        ):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        rows = self.connection.execute(
+            f"SELECT * FROM experiments{where} ORDER BY offset", params
+        )
+        return [IndexEntry(*row) for row in rows]
+
+    def fetch(self, experiment_id: str) -> Optional[dict]:
+        entry = self.lookup(experiment_id)
+        if entry is None:
+            return None
+        return self.load(entry)
+
+    def load(self, entry: IndexEntry) -> dict:
+        _, value = _parse_entry(self._read(entry.offset, entry.length))
+        return value
+
+    def iter_entries(self, after_offset: int = -1) -> Iterator[IndexEntry]:
+        """Experiments stored after the given byte offset, in file order.
+
+        Experiments are only ever appended, so the offset of the last entry
+        seen marks everything written since.
+        """
+        rows = self.connection.execute(
+            "SELECT * FROM experiments WHERE offset > ? ORDER BY offset",
+            (after_offset,),
+        )
+        for row in rows:
+            yield IndexEntry(*row)
+
+    def iter_records(self, entries: Iterable[IndexEntry]) -> Iterator[tuple]:
+        """Yield (experiment_id, record) pairs for entries given in file order."""
+        with open(self.db_file, "rb") as f:
+            for entry in entries:
+                f.seek(entry.offset)
+                yield _parse_entry(f.read(entry.length))
+
+
+def reindex(db_file):
+    """Rewrite a results store in the layout the index needs, and index it.
+
+    For files written some other way, e.g. compact or hand-edited JSON, or
+    by a version from before the index; this reads the whole store. The new file is written next to the old one and then
+    swapped in, so the results are never left half written.
+
+    Examples:
+        >>> import tempfile
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> db_file = pathlib.Path(directory.name) / "results.json"
+        >>> _ = db_file.write_text(json.dumps(
+        ...     {"e1": {"participant_name": "ann"}, "e2": {}}))
+        >>> try:
+        ...     ResultsIndex(db_file)
+        ... except StoreLayoutError as e:
+        ...     print(e)
+        unexpected line at byte 0
+        >>> reindex(db_file)
+        >>> list(json.loads(db_file.read_text()))
+        ['e1', 'e2']
+        >>> with ResultsIndex(db_file) as index:
+        ...     print(index.fetch("e1"))
+        {'participant_name': 'ann'}
+        >>> directory.cleanup()
+    """
+    db_file = pathlib.Path(db_file)
+    with open(db_file, "r") as f:
+        db = json.load(f)
+
+    entries = list(db.items())
+
+    temporary = db_file.with_name(db_file.name + ".tmp")
+    with open(temporary, "wb") as f:
+        if entries:
+            f.write(b"{\n")
+            f.write(b",\n".join(_entry_bytes(key, value) for key, value in entries))
+            f.write(b"\n}")
+        else:
+            f.write(b"{}")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, db_file)
+
+    index_path(db_file).unlink(missing_ok=True)
+    ResultsIndex(db_file).close()
+
+
+def append_experiments(db_file, db: dict):
+    """Append a session's experiments to the results store, updating its index."""
+    with ResultsIndex(db_file) as index:
+        index.append(db)
+
+
+# =============================================================================
+# Command line
+# =============================================================================
+
+app = typer.Typer()
+
+
+@app.command()
+def query(
+    db_file: Annotated[
+        pathlib.Path,
+        typer.Option(help="file where the experimental results are stored"),
+    ] = "experiment_results.json",
+    experiment_id: Annotated[
+        Optional[str], typer.Option(help="fetch a single experiment by id")
+    ] = None,
+    participant: Annotated[Optional[str], typer.Option()] = None,
+    robot: Annotated[Optional[str], typer.Option()] = None,
+    since: Annotated[
+        Optional[str], typer.Option(help="earliest start date (ISO format)")
+    ] = None,
+    until: Annotated[
+        Optional[str], typer.Option(help="latest start date, exclusive (ISO format)")
+    ] = None,
+    full: Annotated[
+        bool, typer.Option("--full", help="print the full experiment records")
+    ] = False,
+):
+    """Find experiments in the results store using its index."""
+    if not db_file.exists():
+        raise typer.BadParameter(f"Results file not found: {db_file}")
+
+    try:
+        index = ResultsIndex(db_file)
+    except StoreLayoutError as e:
+        raise typer.BadParameter(f"{db_file}: {e}; run `reindex` first")
+
+    with index:
+        if experiment_id is not None:
+            entry = index.lookup(experiment_id)
+            entries = [] if entry is None else [entry]
+        else:
+            entries = index.filter(participant, robot, since, until)
+
+        if full:
+            # Printed one record at a time, as json.dumps(records, indent=4)
+            # would print them all
+            separator = "{\n"
+            for experiment_id, record in index.iter_records(entries):
+                print(separator, end="")
+                print(_entry_bytes(experiment_id, record).decode(), end="")
+                separator = ",\n"
+            print("{}" if separator == "{\n" else "\n}")
+        else:
+            for entry in entries:
+                print(
+                    f"{entry.experiment_id}\t{entry.participant}\t"
+                    f"{entry.robot}\t{entry.start_date}"
+                )
+
+
+@app.command("reindex")
+def reindex_command(
+    db_file: Annotated[
+        pathlib.Path,
+        typer.Option(help="file where the experimental results are stored"),
+    ] = "experiment_results.json",
+):
+    """Rewrite the results store in the layout its index needs, and index it."""
+    if not db_file.exists():
+        raise typer.BadParameter(f"Results file not found: {db_file}")
+
+    reindex(db_file)
+    with ResultsIndex(db_file) as index:
+        print(f"Indexed {len(index.filter())} experiments in {db_file}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+from typing import Dict, Union
+
+# from social_norms_trees.behavior_tree_library import Behavior, Composite, Sequence, Selector
+from behavior_tree_library import Behavior, Composite, Sequence, Selector
+
+_logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Canonical structural hashing
+# =============================================================================
+
+# A node's hash is derived from its kind, id, name and the hashes of its
+# children -- everything the tree store keeps -- so two trees have the same
+# hash exactly when they would be stored the same. Hashes are cached on the
+# nodes; `Composite.add_child`, `insert_child` and `remove_child` (and so
+# `insert`, `remove` and `move`) clear the cache along the path from the
+# touched node to the root, so rehashing after an edit only revisits that path.
+
+NODE_KINDS = {
+    "Behavior": Behavior,
+    "Sequence": Sequence,
+    "Selector": Selector,
+}
+
+
+def tree_hash(node: Union[Behavior, Composite]) -> str:
+    """Return the canonical structural hash of a tree.
+
+    Examples:
+        >>> a = Behavior(name="A", id="a")
+        >>> b = Behavior(name="B", id="b")
+        >>> tree = Sequence("goal", children=[a, b])
+        >>> other = Sequence("goal", children=[Behavior("A", "a"), Behavior("B", "b")])
+        >>> tree_hash(tree) == tree_hash(other)
+        True
+
+        The order of children matters, as does the kind of the composite:
+        >>> tree_hash(tree) == tree_hash(Sequence("goal", children=[b, a]))
+        False
+        >>> tree_hash(Sequence("goal")) == tree_hash(Selector("goal"))
+        False
+
+        So do display names, and an id is never confused with a name:
+        >>> tree_hash(Behavior("A", "a")) == tree_hash(Behavior("A (renamed)", "a"))
+        False
+        >>> tree_hash(Behavior("x")) == tree_hash(Behavior("", "x"))
+        False
+
+        Cached hashes are cleared along the edited path:
+        >>> before = tree_hash(tree)
+        >>> tree.remove_child(b)
+        >>> tree._hash is None
+        True
+        >>> tree_hash(tree) == before
+        False
+        >>> tree.add_child(b)
+        >>> tree_hash(tree) == before
+        True
+    """
+    if node._hash is not None:
+        return node._hash
+
+    # JSON keeps the fields apart and tells a missing id from an empty one
+    fields = [type(node).__name__, getattr(node, "id", None), node.name]
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps(fields).encode())
+    for child in getattr(node, "children", ()):
+        digest.update(b"\0")
+        digest.update(tree_hash(child).encode())
+
+    node._hash = digest.hexdigest()
+    return node._hash
+
+
+# =============================================================================
+# Content-addressed tree store
+# =============================================================================
+
+# The results file keeps each milestone's trees as lists of child ids, next to
+# their hashes, so readers of the results need nothing from this module. The
+# store below is for analyses that collect the trees of many sessions: it is a
+# plain dict mapping a hash to the record of one node, and each record refers
+# to its children by hash, so identical subtrees are only ever kept once.
+
+TreeStore = Dict[str, dict]
+
+
+def intern_tree(store: TreeStore, node: Union[Behavior, Composite]) -> str:
+    """Add a tree to the store (if not already present) and return its hash.
+
+    Examples:
+        >>> store = {}
+        >>> tree = Sequence("goal", children=[Behavior("A", "a"), Behavior("B", "b")])
+        >>> same = Sequence("goal", children=[Behavior("A", "a"), Behavior("B", "b")])
+        >>> intern_tree(store, tree) == intern_tree(store, same)
+        True
+        >>> len(store)
+        3
+    """
+    key = tree_hash(node)
+    if key in store:
+        return key
+
+    record = {"kind": type(node).__name__, "name": node.name}
+    if isinstance(node, Composite):
+        record["children"] = [intern_tree(store, child) for child in node.children]
+    else:
+        record["id"] = node.id
+
+    store[key] = record
+    return key
+
+
+def load_tree(store: TreeStore, key: str) -> Union[Behavior, Composite]:
+    """Rebuild the tree stored under the given hash.
+
+    Examples:
+        >>> store = {}
+        >>> tree = Sequence("goal", children=[Behavior("A", "a"), Behavior("B", "b")])
+        >>> key = intern_tree(store, tree)
+        >>> load_tree(store, key)
+        ... # doctest: +NORMALIZE_WHITESPACE
+        Sequence(name='goal', children=[Behavior(name='A', id='a'),
+                                        Behavior(name='B', id='b')])
+        >>> tree_hash(load_tree(store, key)) == key
+        True
+
+        A renamed behavior is stored separately, so it loads back renamed:
+        >>> renamed = Sequence("goal", children=[Behavior("A (renamed)", "a"),
+        ...                                      Behavior("B", "b")])
+        >>> load_tree(store, intern_tree(store, renamed)).children[0].name
+        'A (renamed)'
+    """
+    record = store[key]
+    kind = NODE_KINDS[record["kind"]]
+    if issubclass(kind, Composite):
+        children = [load_tree(store, child) for child in record["children"]]
+        node = kind(name=record["name"], children=children)
+    else:
+        node = kind(name=record["name"], id=record["id"])
+
+    node._hash = key
+    return node
+
+
+def group_by_tree(records, key: str = "final_subtree_hash") -> Dict[str, list]:
+    """Group milestone records by the hash stored under `key`.
+
+    Examples:
+        >>> records = [{"final_subtree_hash": "x"}, {"final_subtree_hash": "y"},
+        ...            {"final_subtree_hash": "x"}]
+        >>> {h: len(group) for h, group in group_by_tree(records).items()}
+        {'x': 2, 'y': 1}
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(record[key], []).append(record)
+    return groups
@@ -4,7 +4,6 @@ from typing import Annotated, List
 import click
 from datetime import datetime
 import json
-import os
 import uuid
 import traceback
 import time
@@ -18,32 +17,56 @@ import importlib.resources as pkg_resources
 
 from behavior_tree_library import Behavior, Sequence
 from atomic_mutations import remove, insert, move
+from tree_hashing import tree_hash
+from event_log import ActionLog, MOVE, REMOVE, ADD
+from results_index import ResultsIndex, StoreLayoutError, append_experiments
+from resource_watcher import ResourceWatcher
+from resource_validation import compile_resources, compile_subgoal
 
 from interactive_ui import run_interactive_list
 
+_logger = logging.getLogger(__name__)
 
 SLEEP_TIME = 2
 
 
-def load_db(db_file):
-    if os.path.exists(db_file):
-        with open(db_file, "r") as f:
-            return json.load(f)
-    else:
-        return {}
+def check_db(db_file):
+    """Makes sure the results can be appended to db_file, before a session starts."""
+    try:
+        ResultsIndex(db_file).close()
+    except StoreLayoutError as e:
+        raise typer.BadParameter(
+            f"{db_file} can't be appended to ({e}); run "
+            f"`social-norms-trees-results reindex --db-file {db_file}` first"
+        )
 
 
 def save_db(db, db_file):
-    """Saves the Python dictionary back to db.json."""
+    """Appends the experiments in the Python dictionary to db.json.
+
+    Only the new records are written; the rest of the file and its index are
+    left in place. If that fails, the session is written to a file of its own
+    next to db_file instead, so it isn't lost. Returns the file written to.
+    """
+    db_file = pathlib.Path(db_file)
 
     print(f"Writing results of simulation to {db_file}...")
     time.sleep(SLEEP_TIME)
-    print("Done.")
 
-    json_representation = json.dumps(db, indent=4)
+    try:
+        append_experiments(db_file, db)
+    except Exception:
+        _logger.exception("Could not append the results to %s", db_file)
+        fallback = db_file.with_name(
+            f"{db_file.stem}-unsaved-{datetime.now():%Y%m%dT%H%M%S}{db_file.suffix}"
+        )
+        with open(fallback, "w") as f:
+            json.dump(db, f, indent=4)
+        print(f"Could not write to {db_file}; the results were saved to {fallback}.")
+        return fallback
 
-    with open(db_file, "w") as f:
-        f.write(json_representation)
+    print("Done.")
+    return db_file
 
 
 def experiment_setup(db, resource_file):
@@ -62,13 +85,12 @@ def participant_login():
     return name
 
 
+# behaviors = behavior id -> name, as compiled by compile_subgoal
 def deserialize_behaviors(behaviors):
     deserialized_behaviors = {}
 
-    for behavior in behaviors:
-        deserialized_behaviors[behavior["id"]] = Behavior(
-            id=behavior["id"], name=behavior["name"]
-        )
+    for behavior_id, name in behaviors.items():
+        deserialized_behaviors[behavior_id] = Behavior(id=behavior_id, name=name)
 
     return deserialized_behaviors
 
@@ -76,12 +98,7 @@ def deserialize_behaviors(behaviors):
 def build_tree(subtree, children, behaviors):
     children_behaviors = []
 
-    parent_node = Sequence(
-        name=subtree,
-    )
-
     for behavior_id in children:
-        behaviors[behavior_id].parent = parent_node
         children_behaviors.append(behaviors[behavior_id])
 
     return Sequence(name=subtree, children=children_behaviors)
@@ -95,15 +112,10 @@ def serialize_tree(behavior_tree):
     return children_list
 
 
-# behaviors = deserialized behavious
-# behavior_list = array of all behaviors
-def build_behavior_bank(behaviors, behavior_list):
-    behavior_bank = []
-
-    for behavior in behavior_list:
-        if "in_behavior_bank" in behavior and behavior["in_behavior_bank"]:
-            behavior_bank.append(behaviors[behavior["id"]])
-    return behavior_bank
+# behaviors = deserialized behaviors
+# bank = ids of the behaviors in the behavior bank
+def build_behavior_bank(behaviors, bank):
+    return [behaviors[behavior_id] for behavior_id in bank]
 
 
 def display_tree(node, indent=0):
@@ -117,48 +129,67 @@ def display_tree(node, indent=0):
         print(" " * indent + " -> " + node.name)
 
 
-def load_resources(resource_file):
+def find_resource_file(resource_file):
     try:
-        print(f"\nLoading behavior tree and behavior library from {resource_file}...\n")
         # Use importlib.resources to access files within the package
-        resource_file = pkg_resources.files("examples") / resource_file
-        with resource_file.open() as f:
-            resources = json.load(f)
-
-    except (FileNotFoundError, ModuleNotFoundError):
-        # Fallback to a local directory for development purposes
-        local_dir = os.path.join(os.path.dirname(__file__), "../examples")
-        resource_path = os.path.join(local_dir, resource_file)
-        if not os.path.exists(resource_path):
-            raise RuntimeError(f"Resource file not found: {resource_file}")
+        resource_path = pathlib.Path(
+            str(pkg_resources.files("examples") / resource_file)
+        )
+        if resource_path.exists():
+            return resource_path
+    except ModuleNotFoundError:
+        pass
+
+    # Fallback to a local directory for development purposes
+    resource_path = pathlib.Path(__file__).parent / "../examples" / resource_file
+    if not resource_path.exists():
+        raise RuntimeError(f"Resource file not found: {resource_file}")
+    return resource_path
+
+
+def read_resources(resource_path):
+    try:
         with open(resource_path, "r") as f:
-            resources = json.load(f)
+            return json.load(f)
 
-    except json.JSONDecodeError:
-        raise ValueError("Error")
-    except Exception:
-        raise RuntimeError("Error")
+    except json.JSONDecodeError as e:
+        raise ValueError(
+            f"Invalid JSON in {resource_path}, line {e.lineno} column {e.colno}: {e.msg}"
+        ) from e
+    except OSError as e:
+        raise RuntimeError(f"Could not read {resource_path}: {e}") from e
 
-    all_resources = {}
 
-    for subtree in resources:
-        children = resources[subtree].get("children")
-        behavior_list = resources[subtree].get("behavior_library")
-        context_paragraph = resources[subtree].get("context")
+def build_compiled_subgoal(compiled):
+    # deserialize the behavior library
+    deserialized_behaviors = deserialize_behaviors(compiled.behaviors)
+
+    # then use it to build the subgoal behavior tree
+    sub_tree = build_tree(compiled.name, compiled.children, deserialized_behaviors)
+
+    behavior_bank = build_behavior_bank(deserialized_behaviors, compiled.bank)
+
+    return {
+        "context": compiled.context,
+        "behaviors": behavior_bank,
+        "sub_tree": sub_tree,
+    }
+
 
-        # deserialize behavior_list
-        deserialized_behaviors = deserialize_behaviors(behavior_list)
+def build_subgoal(subtree, subgoal):
+    return build_compiled_subgoal(compile_subgoal(subtree, subgoal))
 
-        # then use it to build the subgoal behavior tree
-        sub_tree = build_tree(subtree, children, deserialized_behaviors)
 
-        behavior_bank = build_behavior_bank(deserialized_behaviors, behavior_list)
+def load_resources(resource_file, resources):
+    print(f"\nLoading behavior tree and behavior library from {resource_file}...\n")
 
-        all_resources[subtree] = {
-            "context": context_paragraph,
-            "behaviors": behavior_bank,
-            "sub_tree": sub_tree,
-        }
+    # Reports every problem in the file at once, before anything is built
+    compiled = compile_resources(resources)
+
+    all_resources = {}
+
+    for subtree in compiled:
+        all_resources[subtree] = build_compiled_subgoal(compiled[subtree])
 
     return all_resources
 
@@ -221,6 +252,7 @@ def run_tree_manipulation(behavior_library, tree, db):
                 if action == 1:
                     # Select node to be moved
                     selected_node = run_interactive_list(tree.children, mode="select")
+                    source_index = tree.children.index(selected_node)
                     # Select position of node
                     selected_index = run_interactive_list(
                         tree.children, mode="move", new_behavior=selected_node
@@ -228,31 +260,27 @@ def run_tree_manipulation(behavior_library, tree, db):
                     # Perform operation
                     move(selected_node, (tree, selected_index))
 
-                    action_log = {
-                        "type": "move_node",
-                        "nodes": [
-                            {
-                                "display_name": selected_node.name,
-                            },
-                        ],
-                        "timestamp": datetime.now().isoformat(),
-                    }
-                    db["action_history"].append(action_log)
+                    db["action_log"].record(
+                        MOVE,
+                        selected_node.id,
+                        selected_node.name,
+                        source=source_index,
+                        target=selected_index,
+                    )
 
                 elif action == 2:
                     # Select node to be removed
                     selected_node = run_interactive_list(tree.children, mode="select")
+                    source_index = tree.children.index(selected_node)
                     # Perform operation
                     remove(selected_node, tree)
 
-                    action_log = {
-                        "type": "remove_node",
-                        "nodes": [
-                            {"display_name": selected_node.name},
-                        ],
-                        "timestamp": datetime.now().isoformat(),
-                    }
-                    db["action_history"].append(action_log)
+                    db["action_log"].record(
+                        REMOVE,
+                        selected_node.id,
+                        selected_node.name,
+                        source=source_index,
+                    )
 
                 elif action == 3:
                     # TODO: think about where the new action should originally show up in the list. It's original position could
@@ -269,12 +297,12 @@ def run_tree_manipulation(behavior_library, tree, db):
                     # Perform operation
                     insert(selected_node, (tree, selected_index))
 
-                    action_log = {
-                        "type": "add_node",
-                        "node": {"name": selected_node.name},
-                        "timestamp": datetime.now().isoformat(),
-                    }
-                    db["action_history"].append(action_log)
+                    db["action_log"].record(
+                        ADD,
+                        selected_node.id,
+                        selected_node.name,
+                        target=selected_index,
+                    )
 
             else:
                 break
@@ -292,7 +320,9 @@ def run_tree_manipulation(behavior_library, tree, db):
 def run_milestone(subgoal_resources, title, db):
     db["start_time"] = datetime.now().isoformat()
     db["base_subtree"] = serialize_tree(subgoal_resources["sub_tree"])
-    db["action_history"] = []
+    # Identical trees have the same hash, see tree_hashing.group_by_tree
+    db["base_subtree_hash"] = tree_hash(subgoal_resources["sub_tree"])
+    db["action_log"] = ActionLog()
 
     # present context for this subgoal
     print("\n =========================================================")
@@ -303,6 +333,10 @@ def run_milestone(subgoal_resources, title, db):
     time.sleep(SLEEP_TIME)
 
     summarize_behaviors_check(subgoal_resources, db)
+    # action_history keeps its existing shape for readers of the results; the
+    # columns add the node ids and positions it doesn't have
+    db["action_history"] = db["action_log"].to_json()
+    db["action_log"] = db["action_log"].to_columns()
 
     time.sleep(SLEEP_TIME)
     print("\nBot: Okay, I will begin.")
@@ -319,6 +353,7 @@ def run_milestone(subgoal_resources, title, db):
         print(f"Action in progress..")
 
     db["final_subtree"] = serialize_tree(subgoal_resources["sub_tree"])
+    db["final_subtree_hash"] = tree_hash(subgoal_resources["sub_tree"])
     db["end_time"] = datetime.now().isoformat()
 
     print(f"\nBot: The following milestone has been reached: {title}\n")
@@ -328,10 +363,22 @@ def sub_function():
     print("subfunction pressed.")
 
 
-def run_experiment(db, all_resources, experiment_id):
+def run_experiment(db, all_resources, experiment_id, watcher=None):
     # Loop for the actual experiment part, which takes user input to decide which action to take
 
-    for subgoal in all_resources:
+    completed = set()
+
+    while True:
+        if watcher is not None:
+            # Pick up edits to the resource file between milestones
+            watcher.reload(all_resources)
+
+        remaining = [subgoal for subgoal in all_resources if subgoal not in completed]
+        if not remaining:
+            break
+        subgoal = remaining[0]
+        completed.add(subgoal)
+
         db[experiment_id]["experiment_progression"][subgoal] = {}
         run_milestone(
             all_resources[subgoal],
@@ -355,6 +402,12 @@ def main(
         pathlib.Path,
         typer.Option(help="file where the experimental results will be written"),
     ] = "experiment_results.json",
+    watch: Annotated[
+        bool,
+        typer.Option(
+            "--watch", help="reload subgoals when the resource file is edited"
+        ),
+    ] = False,
     verbose: Annotated[bool, typer.Option("--verbose")] = False,
     debug: Annotated[bool, typer.Option("--debug")] = False,
 ):
@@ -369,11 +422,19 @@ def main(
 
     print("AIT Prototype #1 Simulator")
 
-    db = load_db(db_file)
+    # Only this session's records are kept in memory; save_db appends them
+    db = {}
+    check_db(db_file)
 
     # load robot profile to run experiment on, and behavior library
     resource_file = f"{robot}-resource-file.json"
-    all_resources = load_resources(resource_file)
+    resource_path = find_resource_file(resource_file)
+    resources = read_resources(resource_path)
+    all_resources = load_resources(resource_file, resources)
+    watcher = None
+    if watch:
+        # Starts from the JSON just loaded, so an edit made since is picked up
+        watcher = ResourceWatcher(resource_path, build_subgoal, resources)
 
     name, experiment_id = experiment_setup(db, resource_file)
 
@@ -383,9 +444,9 @@ def main(
         f"Bot: Hello {name}, welcome to the agent iteractive training experiment! My name is {robot}. We will be working together to achieve a specific milestone. I will first provide you with a list of actions I plan to take to accomplish the goal. After reviewing the list, you will have the opportunity to make any adjustments to these actions. Once you're satisfied with the plan, I will perform the actions. Let's begin!"
     )
     time.sleep(SLEEP_TIME)
-    db = run_experiment(db, all_resources, experiment_id)
+    db = run_experiment(db, all_resources, experiment_id, watcher)
 
-    save_db(db, db_file)
+    db_file = save_db(db, db_file)
 
     # TODO: Add more context to simulation ending
     print(